@@ -6,11 +6,30 @@ Handles batching of documents (25 per API call) for large document sets.
 
 import boto3
 import argparse
+import concurrent.futures
+import functools
+import itertools
+import random
+import threading
 import time
 import logging
 import json
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
+# orjson is a C-implemented serializer that is several times faster than
+# the stdlib for the nested dicts boto3 returns; fall back to json when
+# it isn't installed since these paths are debug-only
+try:
+    import orjson
+
+    def _dumps(obj, indent=False):
+        option = orjson.OPT_INDENT_2 if indent else 0
+        return orjson.dumps(obj, option=option, default=str).decode()
+except ImportError:
+    def _dumps(obj, indent=False):
+        return json.dumps(obj, default=str, indent=2 if indent else None)
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -18,81 +37,184 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-def list_s3_objects(bucket, prefix=''):
-    """List all objects in an S3 bucket with the given prefix."""
-    s3_client = boto3.client('s3')
-    paginator = s3_client.get_paginator('list_objects_v2')
-    
-    all_objects = []
-    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
-        if 'Contents' in page:
-            all_objects.extend([obj['Key'] for obj in page['Contents']])
-    
-    return all_objects
+@functools.lru_cache(maxsize=None)
+def _s3_client(region=None):
+    """Cached S3 client: construction walks the botocore loader and parses
+    the service model, so repeated calls should reuse one instance."""
+    return boto3.client('s3', region_name=region)
 
-def batch_documents(s3_objects, bucket, batch_size=25):
-    """Create batches of S3 document references."""
-    batches = []
-    current_batch = []
-    
-    for obj_key in s3_objects:
-        if len(current_batch) >= batch_size:
-            batches.append(current_batch)
-            current_batch = []
-        
-        # Skip folders or empty objects
-        if obj_key.endswith('/'):
-            continue
-            
-        current_batch.append({
-            'content': {
-                'dataSourceType': 'S3',
-                's3': {
-                    's3Location': {
-                        'uri': f"s3://{bucket}/{obj_key}"
-                    }
+@functools.lru_cache(maxsize=None)
+def _bedrock_agent_client(region, max_pool_connections=10):
+    """Cached bedrock-agent client with adaptive retries and a connection
+    pool sized for the configured concurrency.
+
+    boto3 clients are thread-safe for API calls (not for mutation), so
+    the worker threads all share this one instance; the pool size keeps
+    their HTTP sends from serializing on urllib3's default 10
+    connections, and TCP keepalive avoids reconnects between batches.
+    """
+    return boto3.client(
+        'bedrock-agent',
+        region_name=region,
+        config=Config(
+            max_pool_connections=max_pool_connections,
+            retries={'mode': 'adaptive', 'max_attempts': 10},
+            tcp_keepalive=True
+        )
+    )
+
+def iter_s3_objects(bucket, prefix='', start_after=None, skip_metadata=False):
+    """Yield object keys from an S3 bucket with the given prefix, page by page.
+
+    PageSize is pinned to the ListObjectsV2 maximum (1000) to minimize
+    round-trips. Pass start_after to resume a listing after a known key
+    instead of re-listing the bucket from the beginning. With
+    skip_metadata, .metadata.json keys are dropped by a JMESPath filter
+    inside botocore before they are ever materialized as Python strings.
+    """
+    paginator = _s3_client().get_paginator('list_objects_v2')
+
+    paginate_kwargs = {
+        'Bucket': bucket,
+        'Prefix': prefix,
+        'PaginationConfig': {'PageSize': 1000},
+    }
+    if start_after:
+        paginate_kwargs['StartAfter'] = start_after
+
+    pages = paginator.paginate(**paginate_kwargs)
+    if skip_metadata:
+        for key in pages.search("Contents[?!ends_with(Key, `.metadata.json`)].Key"):
+            if key is not None:
+                yield key
+    else:
+        for page in pages:
+            for obj in page.get('Contents', ()):
+                yield obj['Key']
+
+def load_checkpoint(state_file):
+    """Read the last successfully ingested key from the state file, if any."""
+    try:
+        with open(state_file) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f"Error reading state file {state_file}: {e}. Starting from the beginning.")
+        return None
+
+def save_checkpoint(state_file, last_key):
+    """Persist the last successfully ingested key for crash recovery."""
+    try:
+        with open(state_file, 'w') as f:
+            f.write(last_key + '\n')
+    except Exception as e:
+        logger.warning(f"Error writing state file {state_file}: {e}")
+
+def iter_batches(keys, batch_size=25):
+    """Yield batches of object keys as soon as each batch fills.
+
+    Folder markers are skipped and duplicate keys (possible across
+    prefixed sub-listings) are dropped in the same single pass, so a key
+    is never ingested twice and nothing beyond the current batch and the
+    seen-set is buffered. Batches carry plain keys; the ingest API
+    payload is built once per batch in ingest_documents_batch.
+    """
+    seen = set()
+    filtered = (
+        obj_key for obj_key in keys
+        if not obj_key.endswith('/') and not (obj_key in seen or seen.add(obj_key))
+    )
+    while batch := list(itertools.islice(filtered, batch_size)):
+        yield batch
+
+def build_document(uri_prefix, obj_key):
+    """Build the ingest API payload for a single S3 object.
+
+    Only used for debug output; the hot path in ingest_documents_batch
+    inlines this construction to avoid a function call per key.
+    """
+    return {
+        'content': {
+            'dataSourceType': 'S3',
+            's3': {
+                's3Location': {
+                    'uri': uri_prefix + obj_key
                 }
             }
-        })
-    
-    # Add the last batch if it's not empty
-    if current_batch:
-        batches.append(current_batch)
-    
-    return batches
+        }
+    }
+
+class RateLimiter:
+    """Token-bucket pacing shared across worker threads.
+
+    Only sleeps when the configured requests-per-second rate is actually
+    being exceeded, unlike a fixed delay between batches.
+    """
+    def __init__(self, rps):
+        self._interval = 1.0 / rps if rps > 0 else 0.0
+        self._lock = threading.Lock()
+        self._next_allowed = time.monotonic()
 
-def retry_with_backoff(func, max_retries=100, initial_delay=100):
-    """Retry a function with exponential backoff."""
+    def acquire(self):
+        if not self._interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next_allowed - now
+            self._next_allowed = max(now, self._next_allowed) + self._interval
+        if wait > 0:
+            time.sleep(wait)
+
+def retry_with_backoff(func, max_retries=8, initial_delay=1.0, max_delay=60.0):
+    """Retry a function with capped, decorrelated-jitter backoff.
+
+    Jitter keeps concurrent workers from synchronizing their retries and
+    re-colliding; the cap bounds the worst-case sleep.
+    """
+    delay = initial_delay
     for attempt in range(max_retries):
         try:
             return func()
         except ClientError as e:
-            if "ValidationException" in str(e) and "concurrent" in str(e):
-                delay = (2 ** attempt) * initial_delay
-                logger.info(f"Concurrent operation limit reached. Retrying in {delay} seconds...")
+            error = e.response.get('Error', {})
+            if error.get('Code') == 'ValidationException' and 'concurrent' in error.get('Message', ''):
+                delay = random.uniform(initial_delay, min(max_delay, delay * 3))
+                logger.info(f"Concurrent operation limit reached. Retrying in {delay:.1f} seconds...")
                 time.sleep(delay)
                 continue
             raise
     raise Exception(f"Failed after {max_retries} retries")
 
 
-def ingest_documents_batch(bedrock_agent_client, knowledge_base_id, data_source_id, documents):
+def ingest_documents_batch(bedrock_agent_client, knowledge_base_id, data_source_id, bucket, batch_keys, rate_limiter=None):
     """Ingest a batch of documents into the knowledge base."""
+    uri_prefix = f"s3://{bucket}/"
+    documents = [
+        {'content': {'dataSourceType': 'S3',
+                     's3': {'s3Location': {'uri': uri_prefix + obj_key}}}}
+        for obj_key in batch_keys
+    ]
+
     def ingest():
+        if rate_limiter is not None:
+            rate_limiter.acquire()
         response = bedrock_agent_client.ingest_knowledge_base_documents(
             knowledgeBaseId=knowledge_base_id,
             dataSourceId=data_source_id,
             documents=documents
         )
         
-        logger.debug(f"API Response: {json.dumps(response, default=str)}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("API Response: %s", _dumps(response))
         
         if 'ingestionJobId' in response:
             return response['ingestionJobId']
         elif 'jobId' in response:
             return response['jobId']
         else:
-            logger.warning(f"Unexpected response format: {json.dumps(response, default=str)}")
+            if logger.isEnabledFor(logging.WARNING):
+                logger.warning("Unexpected response format: %s", _dumps(response))
             return f"unknown-job-{time.time()}"
     
     try:
@@ -117,7 +239,7 @@ def check_ingestion_status(bedrock_agent_client, knowledge_base_id, data_source_
             )
             return response['status']
         except ClientError as e:
-            if "ResourceNotFoundException" in str(e):
+            if e.response.get('Error', {}).get('Code') == 'ResourceNotFoundException':
                 # Try alternative API if the first one fails
                 try:
                     response = bedrock_agent_client.list_ingestion_jobs(
@@ -138,9 +260,52 @@ def check_ingestion_status(bedrock_agent_client, knowledge_base_id, data_source_
         logger.error(f"Error checking ingestion status: {e}")
         return "ERROR"
 
-def filter_metadata_files(s3_objects):
-    """Filter out metadata files to avoid duplicate ingestion."""
-    return [obj for obj in s3_objects if not obj.endswith('.metadata.json')]
+def poll_statuses(bedrock_agent_client, knowledge_base_id, data_source_id, job_ids):
+    """Fetch statuses for many ingestion jobs with one paginated listing.
+
+    A single ListIngestionJobs page covers many jobs, so checking N jobs
+    costs O(1) pages instead of N GetIngestionJob calls.
+    """
+    wanted = {j for j in job_ids if not j.startswith("unknown-job-")}
+    statuses = {}
+    if not wanted:
+        return statuses
+    try:
+        paginator = bedrock_agent_client.get_paginator('list_ingestion_jobs')
+        for page in paginator.paginate(
+            knowledgeBaseId=knowledge_base_id,
+            dataSourceId=data_source_id
+        ):
+            for job in page.get('ingestionJobs', ()):
+                job_id = job.get('ingestionJobId')
+                if job_id in wanted:
+                    statuses[job_id] = job['status']
+            if len(statuses) == len(wanted):
+                break
+    except Exception as e:
+        logger.error(f"Error listing ingestion jobs: {e}")
+    return statuses
+
+def wait_for_ingestion_job(bedrock_agent_client, knowledge_base_id, data_source_id,
+                           ingestion_job_id, initial_delay=2.0, max_delay=60.0):
+    """Poll an ingestion job until it reaches a terminal status.
+
+    Uses exponential backoff (starting at initial_delay, doubling up to
+    max_delay) instead of a fixed polling interval, so short jobs are
+    detected quickly and long jobs don't hammer the status API.
+    """
+    delay = initial_delay
+    status = "IN_PROGRESS"
+    while status in ["IN_PROGRESS", "QUEUED", "PENDING"]:
+        time.sleep(delay)
+        delay = min(max_delay, delay * 2)
+        status = check_ingestion_status(
+            bedrock_agent_client,
+            knowledge_base_id,
+            data_source_id,
+            ingestion_job_id
+        )
+    return status
 
 def main():
     parser = argparse.ArgumentParser(description='Ingest documents into Amazon Bedrock Knowledge Base')
@@ -153,82 +318,181 @@ def main():
     parser.add_argument('--debug', action='store_true', help='Print debug information')
     parser.add_argument('--batch-size', type=int, default=25, help='Number of documents per batch (max 25)')
     parser.add_argument('--skip-metadata', action='store_true', help='Skip .metadata.json files')
+    parser.add_argument('--concurrency', type=int, default=8, help='Number of batches to submit in parallel (ignored with --wait)')
+    parser.add_argument('--start-after', default=None, help='Resume the S3 listing after this key')
+    parser.add_argument('--state-file', default=None, help='File used to checkpoint the last ingested key for resumption')
+    parser.add_argument('--rps', type=float, default=5.0, help='Maximum ingestion requests per second across all workers (0 to disable)')
     args = parser.parse_args()
 
     # Set debug level if requested
     if args.debug:
         logging.getLogger().setLevel(logging.DEBUG)
 
-    # Initialize Bedrock Agent client
-    bedrock_agent_client = boto3.client('bedrock-agent', region_name=args.region)
-    
-    # List all objects in the S3 bucket/prefix
-    logger.info(f"Listing objects in s3://{args.bucket}/{args.prefix}")
-    s3_objects = list_s3_objects(args.bucket, args.prefix)
-    
-    # Filter out metadata files if requested
-    if args.skip_metadata:
-        original_count = len(s3_objects)
-        s3_objects = filter_metadata_files(s3_objects)
-        logger.info(f"Filtered out {original_count - len(s3_objects)} metadata files")
-    
-    logger.info(f"Found {len(s3_objects)} objects in S3")
-    
+    # Initialize Bedrock Agent client. Adaptive retry mode lets botocore
+    # pace requests when the API throttles, so we don't need a fixed sleep
+    # between batch submissions; the connection pool is sized to match the
+    # thread-pool concurrency.
+    bedrock_agent_client = _bedrock_agent_client(
+        args.region,
+        max_pool_connections=max(10, args.concurrency * 2)
+    )
+
+
     # Ensure batch size doesn't exceed API limit
     batch_size = min(args.batch_size, 25)
     if args.batch_size > 25:
         logger.warning(f"Requested batch size {args.batch_size} exceeds API limit. Using maximum of 25.")
-    
-    # Create batches of documents
-    document_batches = batch_documents(s3_objects, args.bucket, batch_size)
-    logger.info(f"Created {len(document_batches)} batches of documents (max {batch_size} per batch)")
-    
-    # Debug: Print the structure of the first document if requested
-    if args.debug and document_batches and document_batches[0]:
-        logger.debug(f"First document structure: {json.dumps(document_batches[0][0], indent=2)}")
-    
+
+    # Resolve the resume point: an explicit --start-after wins over the
+    # checkpoint recorded by a previous run
+    start_after = args.start_after
+    if not start_after and args.state_file:
+        start_after = load_checkpoint(args.state_file)
+        if start_after:
+            logger.info(f"Resuming listing after checkpointed key: {start_after}")
+
+    # Stream the S3 listing straight into batches so ingestion starts while
+    # pagination is still running and memory stays bounded by the batch size
+    logger.info(f"Listing objects in s3://{args.bucket}/{args.prefix}")
+    document_batches = iter_batches(
+        iter_s3_objects(args.bucket, args.prefix, start_after=start_after,
+                        skip_metadata=args.skip_metadata),
+        batch_size
+    )
+
     # Process each batch
     ingestion_jobs = []
-    for i, batch in enumerate(document_batches):
-        logger.info(f"Processing batch {i+1}/{len(document_batches)} with {len(batch)} documents")
-        
-        try:
-            job_id = ingest_documents_batch(
-                bedrock_agent_client, 
-                args.knowledge_base_id,
-                args.data_source_id,
-                batch
-            )
-            ingestion_jobs.append(job_id)
-            logger.info(f"Started ingestion job {job_id} for batch {i+1}")
-            
-            if args.wait:
-                logger.info(f"Waiting for batch {i+1} to complete...")
-                status = "IN_PROGRESS"
-                while status in ["IN_PROGRESS", "QUEUED", "PENDING"]:
-                    time.sleep(30)  # Check every 30 seconds
-                    status = check_ingestion_status(
-                        bedrock_agent_client, 
-                        args.knowledge_base_id, 
-                        args.data_source_id,
-                        job_id
-                    )
-                    logger.info(f"Batch {i+1} status: {status}")
-                
-                if status not in ["COMPLETE", "COMPLETED", "SUCCESS"]:
-                    logger.warning(f"Batch {i+1} finished with status: {status}")
-            else:
-                # Add a small delay between batches to avoid throttling
-                time.sleep(2)
-        except Exception as e:
-            logger.error(f"Error processing batch {i+1}: {e}")
-            if args.debug:
-                import traceback
-                logger.debug(traceback.format_exc())
-    
+    uri_prefix = f"s3://{args.bucket}/"
+    batch_last_keys = {}
+    rate_limiter = RateLimiter(args.rps)
+    # The checkpoint may only advance over a contiguous prefix of
+    # successful batches; after the first failure a later batch's key
+    # would make a resume skip the failed batch's keys permanently
+    checkpoint_ok = True
+
+    def wait_and_report(index, job_id):
+        nonlocal checkpoint_ok
+        logger.info(f"Waiting for batch {index+1} to complete...")
+        status = wait_for_ingestion_job(
+            bedrock_agent_client,
+            args.knowledge_base_id,
+            args.data_source_id,
+            job_id
+        )
+        logger.info(f"Batch {index+1} status: {status}")
+        if status in ["COMPLETE", "COMPLETED", "SUCCESS"]:
+            # Wait mode completes batches in listing order, so the last
+            # key of this batch is a safe resume point as long as every
+            # earlier batch also completed
+            if args.state_file and checkpoint_ok:
+                save_checkpoint(args.state_file, batch_last_keys[index])
+        else:
+            checkpoint_ok = False
+            logger.warning(f"Batch {index+1} finished with status: {status}")
+
+    if args.wait:
+        # Wait mode used to serialize submit -> poll -> submit. A single
+        # background submitter overlaps the next batch's S3 listing and
+        # ingestion call with the current job's status polling, while
+        # keeping at most one extra ingestion request in flight.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as submitter:
+            prev_index = None
+            prev_job_id = None
+            for i, batch in enumerate(document_batches):
+                # Debug: Print the structure of the first document if requested
+                if i == 0 and batch and logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("First document structure: %s", _dumps(build_document(uri_prefix, batch[0]), indent=True))
+
+                logger.info(f"Submitting batch {i+1} with {len(batch)} documents")
+                batch_last_keys[i] = batch[-1]
+                submit_future = submitter.submit(
+                    ingest_documents_batch,
+                    bedrock_agent_client,
+                    args.knowledge_base_id,
+                    args.data_source_id,
+                    args.bucket,
+                    batch,
+                    rate_limiter
+                )
+
+                # Poll the previous job while the new submission is in flight
+                if prev_job_id is not None:
+                    wait_and_report(prev_index, prev_job_id)
+                    prev_job_id = None
+
+                try:
+                    job_id = submit_future.result()
+                    ingestion_jobs.append(job_id)
+                    logger.info(f"Started ingestion job {job_id} for batch {i+1}")
+                    prev_index, prev_job_id = i, job_id
+                except Exception as e:
+                    checkpoint_ok = False
+                    logger.error(f"Error processing batch {i+1}: {e}")
+                    if args.debug:
+                        import traceback
+                        logger.debug(traceback.format_exc())
+
+            if prev_job_id is not None:
+                wait_and_report(prev_index, prev_job_id)
+    else:
+        # Submission is I/O-bound, so a bounded thread pool gives near-linear
+        # speedup until Bedrock's concurrent-ingestion quota is hit.
+        # retry_with_backoff still handles "concurrent operation" errors.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            futures = {}
+            for i, batch in enumerate(document_batches):
+                # Debug: Print the structure of the first document if requested
+                if i == 0 and batch and logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("First document structure: %s", _dumps(build_document(uri_prefix, batch[0]), indent=True))
+
+                logger.info(f"Submitting batch {i+1} with {len(batch)} documents")
+                batch_last_keys[i] = batch[-1]
+                future = executor.submit(
+                    ingest_documents_batch,
+                    bedrock_agent_client,
+                    args.knowledge_base_id,
+                    args.data_source_id,
+                    args.bucket,
+                    batch,
+                    rate_limiter
+                )
+                futures[future] = i
+
+            # Batches complete out of order here, so only advance the
+            # checkpoint over a contiguous run of submitted batches
+            submitted = set()
+            checkpoint_frontier = 0
+            for future in concurrent.futures.as_completed(futures):
+                i = futures[future]
+                try:
+                    job_id = future.result()
+                    ingestion_jobs.append(job_id)
+                    logger.info(f"Started ingestion job {job_id} for batch {i+1}")
+                    submitted.add(i)
+                    if args.state_file:
+                        frontier_before = checkpoint_frontier
+                        while checkpoint_frontier in submitted:
+                            checkpoint_frontier += 1
+                        if checkpoint_frontier > frontier_before:
+                            save_checkpoint(args.state_file, batch_last_keys[checkpoint_frontier - 1])
+                except Exception as e:
+                    logger.error(f"Error processing batch {i+1}: {e}")
+                    if args.debug:
+                        import traceback
+                        logger.debug(traceback.format_exc())
+
+
     logger.info(f"Started {len(ingestion_jobs)} ingestion jobs")
+    # One listing call annotates the whole summary instead of N
+    # per-job status lookups
+    statuses = poll_statuses(
+        bedrock_agent_client,
+        args.knowledge_base_id,
+        args.data_source_id,
+        ingestion_jobs
+    )
     for i, job_id in enumerate(ingestion_jobs):
-        logger.info(f"Batch {i+1}: Job ID {job_id}")
+        logger.info(f"Batch {i+1}: Job ID {job_id} ({statuses.get(job_id, 'UNKNOWN')})")
     
     logger.info("Document ingestion process initiated successfully")
 
@@ -1,9 +1,19 @@
 import chainlit as cl
 from typing import Dict, Optional
 from chainlit.input_widget import Select, Switch, Slider
+import functools
+import hashlib
+import json
+import logging
+import logging.handlers
+import queue
+import re
 import time
+import types
 import asyncio
 
+import numpy as np
+
 from langchain_aws import ChatBedrockConverse
 from langchain.prompts import ChatPromptTemplate
 from langchain.schema import StrOutputParser
@@ -15,30 +25,112 @@ from langchain.chains import RetrievalQA
 import boto3
 from botocore.config import Config
 import botocore.exceptions
-import sys
+import tenacity
 import os
 
+# orjson parses Bedrock's JSON responses (long KB passages in
+# particular) 2-3x faster than the stdlib parser botocore uses. Swap it
+# into the response parser once at import; any orjson failure falls
+# back to the original parse, and missing orjson leaves botocore alone.
+try:
+    import orjson
+    from botocore import parsers as _botocore_parsers
 
-boto3_config = Config(
-    region_name='us-east-1',  # Replace with your region
-    retries={
-        'max_attempts': 3,     # Maximum number of retries
-        'mode': 'standard',    # Use standard retry mode instead of legacy
-    },
-    connect_timeout=10,    # Connection timeout in seconds
-    read_timeout=10,      # Read timeout in seconds
-    max_pool_connections=10,  # Maximum connection pool size
-)
+    _original_parse_body_as_json = _botocore_parsers.BaseJSONParser._parse_body_as_json
+
+    def _parse_body_as_json(self, body_contents):
+        if not body_contents:
+            return {}
+        try:
+            return orjson.loads(body_contents)
+        except Exception:
+            return _original_parse_body_as_json(self, body_contents)
+
+    _botocore_parsers.BaseJSONParser._parse_body_as_json = _parse_body_as_json
+
+    # Same treatment on the request side: every retrieval/invoke call
+    # serializes its parameter dicts (retrieval_config, guardrails, ...)
+    # through the stdlib encoder; orjson emits the body bytes directly.
+    from botocore import serialize as _botocore_serialize
+
+    _original_serialize_body_params = _botocore_serialize.JSONSerializer._serialize_body_params
+
+    def _serialize_body_params(self, params, shape):
+        try:
+            serialized_body = self.MAP_TYPE()
+            self._serialize(serialized_body, params, shape)
+            return orjson.dumps(serialized_body)
+        except Exception:
+            return _original_serialize_body_params(self, params, shape)
+
+    _botocore_serialize.JSONSerializer._serialize_body_params = _serialize_body_params
+except (ImportError, AttributeError):
+    pass
+
+
+import threading
+
+
+class BedrockClientManager:
+    """Shared boto3 clients sized for concurrent Chainlit sessions.
+
+    The previous module-level config capped the pool at 10 connections,
+    which throttled Bedrock throughput and produced PoolTimeout tail
+    latencies as soon as a handful of sessions chatted at once. One
+    client per service is built lazily, reused everywhere (including
+    inside LangChain), and backed by a large keep-alive connection pool
+    so concurrent requests don't pay TLS handshakes or queue on sockets.
+    """
+
+    def __init__(self, region_name):
+        self.region_name = region_name
+        self.config = Config(
+            region_name=region_name,
+            retries={
+                'max_attempts': 5,
+                'mode': 'adaptive',   # Client-side rate limiting on throttles
+            },
+            connect_timeout=5,
+            read_timeout=60,          # Long enough for slow LLM completions
+            tcp_keepalive=True,
+            max_pool_connections=int(
+                os.environ.get('BOTOCORE_CLIENT_MAX_POOL_CONNECTIONS', 1000)
+            ),
+        )
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def get_client(self, service_name):
+        client = self._clients.get(service_name)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(service_name)
+                if client is None:
+                    client = boto3.client(service_name,
+                                          region_name=self.region_name,
+                                          config=self.config)
+                    self._clients[service_name] = client
+        return client
+
+
+# Log through a queue drained on a background thread: the event loop
+# never blocks on a stdout flush, which matters during retry storms in
+# containers running unbuffered
+_log_queue = queue.SimpleQueue()
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_handler)
+_log_listener.start()
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get('LOGLEVEL', 'INFO'))
+logger.addHandler(logging.handlers.QueueHandler(_log_queue))
 
-module_path = ".."
-sys.path.append(os.path.abspath(module_path))
 region = 'us-east-1'
-bedrock_client = boto3.client('bedrock-runtime',
-                              region_name=region,
-                              config=boto3_config)
-bedrock_agent_client = boto3.client('bedrock-agent-runtime', 
-                                    region_name=region, 
-                                    config=boto3_config)
+client_manager = BedrockClientManager(region)
+boto3_config = client_manager.config
+bedrock_client = client_manager.get_client('bedrock-runtime')
+bedrock_agent_client = client_manager.get_client('bedrock-agent-runtime')
 
 # USE AURORA POSTGRES
 KNOWLEDGE_BASE_ID = 'your knowledge base id'
@@ -47,46 +139,286 @@ KNOWLEDGE_BASE_ID = 'your knowledge base id'
 GUARDRAIL_ID =  'your guardrail id'
 GUARDRAIL_VERSION = 'DRAFT'
 
-# Retry mechanism for Aurora DB auto-pause resumption
-async def retry_on_aurora_resuming(operation_func, max_retries=10, initial_backoff=5, backoff_multiplier=1.5):
+EMBEDDING_MODEL_ID = 'amazon.titan-embed-text-v2:0'
+
+
+class SemanticCache:
+    """Cosine-similarity cache of previous answers keyed by query embedding.
+
+    Near-duplicate questions (the chat Starters guarantee many) skip the
+    full LLM/KB round-trip: the query is embedded once, compared against
+    cached query embeddings with a numpy matrix-vector product, and on a
+    hit the stored answer is returned in milliseconds. Entries expire
+    after a TTL and the least recently used one is dropped when the
+    cache is full.
     """
-    Retry an async function when Aurora DB is resuming from auto-pause or is stopped.
-    
-    Args:
-        operation_func: The async function to retry
-        max_retries: Maximum number of retry attempts
-        initial_backoff: Initial wait time in seconds
-        backoff_multiplier: Factor by which to increase backoff time after each retry
-        
-    Returns:
-        The result of the operation function
+
+    def __init__(self, threshold=0.95, max_entries=512, ttl_seconds=3600):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._vectors = None   # (N, D) float32 matrix, rows L2-normalized
+        self._entries = []     # parallel list of (answer, source_documents)
+        self._stamps = []      # parallel list of time.monotonic() stamps
+
+    def _keep(self, indices):
+        self._vectors = self._vectors[indices]
+        self._entries = [self._entries[i] for i in indices]
+        self._stamps = [self._stamps[i] for i in indices]
+
+    def _evict_expired(self):
+        if not self._entries:
+            return
+        now = time.monotonic()
+        keep = [i for i, stamp in enumerate(self._stamps)
+                if now - stamp <= self.ttl_seconds]
+        if len(keep) != len(self._entries):
+            self._keep(keep)
+
+    def lookup(self, query_vec):
+        """Return the cached (answer, source_documents) for the closest
+        stored query, or None when nothing is similar enough."""
+        self._evict_expired()
+        if not self._entries:
+            return None
+        query_norm = float(np.linalg.norm(query_vec))
+        if query_norm == 0.0:
+            return None
+        # Rows are unit vectors, so one BLAS matrix-vector product gives
+        # every cosine similarity without a per-row division
+        sims = self._vectors @ (np.asarray(query_vec, dtype=np.float32) / query_norm)
+        idx = int(np.argmax(sims))
+        if sims[idx] < self.threshold:
+            return None
+        # Refresh the hit so frequently asked queries stay resident
+        self._stamps[idx] = time.monotonic()
+        return self._entries[idx]
+
+    def store(self, query_vec, answer, source_documents=None):
+        norm = float(np.linalg.norm(query_vec))
+        if norm == 0.0:
+            return
+        self._evict_expired()
+        if len(self._entries) >= self.max_entries:
+            oldest = min(range(len(self._stamps)), key=self._stamps.__getitem__)
+            self._keep([i for i in range(len(self._entries)) if i != oldest])
+        unit = (np.asarray(query_vec, dtype=np.float32) / norm)[None, :]
+        if self._vectors is None or self._vectors.size == 0:
+            self._vectors = unit
+        else:
+            self._vectors = np.vstack((self._vectors, unit))
+        self._entries.append((answer, source_documents))
+        self._stamps.append(time.monotonic())
+
+
+# One cache per (model, use KB, use agent) combination so cached answers
+# are never served across model or mode changes
+_semantic_caches = {}
+
+def _semantic_cache_for(cache_key):
+    cache = _semantic_caches.get(cache_key)
+    if cache is None:
+        cache = _semantic_caches[cache_key] = SemanticCache()
+    return cache
+
+def _embed_text_sync(text):
+    response = bedrock_client.invoke_model(
+        modelId=EMBEDDING_MODEL_ID,
+        body=json.dumps({"inputText": text})
+    )
+    payload = json.loads(response['body'].read())
+    return np.asarray(payload['embedding'], dtype=np.float32)
+
+class MicroBatchEmbedder:
+    """Coalesce concurrent embedding requests into micro-batches.
+
+    Every session embeds its message independently, so under load the
+    event loop schedules N unrelated single-text Bedrock calls. Embed
+    requests are instead pushed onto a queue; a background task drains
+    up to batch_size of them (or whatever arrived within linger_ms) and
+    issues the calls together, bounding in-flight embedding requests
+    and amortizing scheduling overhead per batch. Titan's InvokeModel
+    takes one inputText per call, so the drained batch is dispatched
+    concurrently rather than as a single request.
     """
-    retries = 0
-    backoff = initial_backoff
-    
-    while True:
+
+    def __init__(self, batch_size=16, linger_ms=10):
+        self.batch_size = batch_size
+        self.linger_s = linger_ms / 1000.0
+        self._queue = None
+        self._task = None
+
+    async def embed(self, text):
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._drain())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, future))
+        return await future
+
+    async def _drain(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.linger_s
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            results = await asyncio.gather(
+                *(asyncio.to_thread(_embed_text_sync, text) for text, _ in batch),
+                return_exceptions=True
+            )
+            for (_, future), result in zip(batch, results):
+                if future.cancelled():
+                    continue
+                if isinstance(result, BaseException):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+
+_micro_batch_embedder = MicroBatchEmbedder()
+
+async def _embed_text(text):
+    return await _micro_batch_embedder.embed(text)
+
+# The three Starter prompts dominate first messages, so their KB
+# retrieval can be done once up front (set WARM_CACHE=1) and reused as
+# a prebuilt context instead of hitting the retriever per user
+STARTER_MESSAGES = (
+    "Can you help me to understand why do I need health insurance?.",
+    "Could you please tell me more about the symptom of common cold?",
+    "Tips for losing weight",
+)
+
+_starter_contexts = {}
+_starter_warm_started = False
+
+def _normalize_query(text):
+    """Lowercase and strip punctuation so trivial rephrasings match."""
+    return re.sub(r'[^\w\s]', '', text.lower()).strip()
+
+async def _warm_starter_cache():
+    for starter_message in STARTER_MESSAGES:
         try:
+            docs = await retriever.aget_relevant_documents(starter_message)
+        except Exception as e:
+            logger.warning("Starter cache warming failed for '%s': %s", starter_message, e)
+            continue
+        context = "\n\n".join(doc.page_content for doc in docs)
+        _starter_contexts[_normalize_query(starter_message)] = context
+
+def _maybe_start_warming():
+    global _starter_warm_started
+    if _starter_warm_started or os.environ.get("WARM_CACHE") != "1":
+        return
+    _starter_warm_started = True
+    asyncio.create_task(_warm_starter_cache())
+
+# The prompt template and guardrail configuration are identical for
+# every settings combination, so they are built once at import instead
+# of being re-parsed on each settings update
+prompt_insurance = ChatPromptTemplate.from_messages(
+[
+    ("system", """You are a health insurance agent and medical expert that is willing to help the user answer questions related to health insurance and common medical topic topics.
+      Your focus is not just selling the insurance product but also solving user's concerns related to healthcare and symptom of disease. Do not do hard selling, be humble.
+      Use the following pieces of context to answer the user's question. If you don't know the answer, just say that you don't know, don't try to make up an answer.
+      Use your internal knowledge first, if you do not have the answer, use knowledge bases, if you still do not know the answer, do not hallucinate. 
+
+     Guidelines:
+      - Only provide factual medical information from reliable sources
+      - Do not give specific medical advice or diagnoses
+      - Refer users to healthcare professionals for medical concerns
+      - Do not discuss sensitive personal health information
+      - Focus on general insurance and healthcare topics
+      - Avoid answering questions unrelated to Insurance and Medical
+      - Never show table name in the response if users asks about insurance
+     """),
+    # The context sits in its own message between the fixed instructions
+    # and the user turn: the instruction prefix is byte-stable across all
+    # requests and the query is strictly last, the layout Bedrock prompt
+    # caching needs to reuse the prefill across turns
+    ("system", "Reference documents:\n{context}"),
+    ("human", "{question}"),
+])
+
+"""
+ChatPromptTemplate Explained:
+system: This is used to baseline the AI assistant. 
+        If you want to set some behaviour of your assistant. 
+        This is the place to do it.
+human: All the user inputs are to stored in this
+"""
+
+# Read-only view: the same mapping is handed to both ChatBedrockConverse
+# and BedrockAgentsRunnable, and neither should be able to mutate it
+guardrails = types.MappingProxyType({
+    'guardrailIdentifier': GUARDRAIL_ID,
+    'guardrailVersion': GUARDRAIL_VERSION,
+    'trace': "enabled"})
+
+
+# Retry mechanism for Aurora DB auto-pause resumption
+_AURORA_RESUMING_MARKERS = ('resuming after being auto-paused', 'is in stopped state')
+
+def _is_aurora_resuming(e):
+    """True when an error means the Aurora vector store is waking up."""
+    if not isinstance(e, botocore.exceptions.ClientError):
+        return False
+    error = e.response.get('Error', {})
+    return (error.get('Code') == 'ValidationException'
+            and any(marker in error.get('Message', '')
+                    for marker in _AURORA_RESUMING_MARKERS))
+
+def _log_aurora_retry(retry_state):
+    logger.info("Aurora DB is not ready. Retrying in %.1f seconds... (Attempt %d/10)",
+                retry_state.next_action.sleep, retry_state.attempt_number)
+
+# The retry policy is built once; each call iterates a cheap copy so
+# concurrent messages don't share attempt state
+_AURORA_RETRYING = tenacity.AsyncRetrying(
+    retry=tenacity.retry_if_exception(_is_aurora_resuming),
+    wait=tenacity.wait_exponential(multiplier=1.5, min=5, max=60),
+    stop=tenacity.stop_after_attempt(10),
+    before_sleep=_log_aurora_retry,
+    reraise=True,
+)
+
+async def retry_on_aurora_resuming(operation_func):
+    """Run an async operation, retrying while Aurora resumes from auto-pause."""
+    async for attempt in _AURORA_RETRYING.copy():
+        with attempt:
             return await operation_func()
-        except botocore.exceptions.ClientError as e:
-            error_code = e.response.get('Error', {}).get('Code', '')
-            error_message = str(e)
-            
-            # Check if error is due to Aurora resuming or being stopped
-            if (error_code == 'ValidationException' and 
-                ('resuming after being auto-paused' in error_message or 
-                 'is in stopped state' in error_message) and 
-                retries < max_retries):
-                
-                print(f"Aurora DB is not ready. Retrying in {backoff} seconds... (Attempt {retries + 1}/{max_retries})")
-                await asyncio.sleep(backoff)
-                retries += 1
-                backoff *= backoff_multiplier
-            else:
-                # If it's a different error or we've exceeded retries, re-raise
-                raise
+
+class StableOrderRetriever(AmazonKnowledgeBasesRetriever):
+    """Knowledge-base retriever that returns documents in stable order.
+
+    Retrieval scores jitter between calls, so the same document set can
+    come back in different orders and produce different prompts. Sorting
+    by source keeps the formatted context byte-identical for identical
+    retrieval sets, which is what lets Bedrock's prompt caching hit on
+    repeat turns.
+    """
+
+    @staticmethod
+    def _doc_sort_key(doc):
+        return str(doc.metadata.get('source')
+                   or doc.metadata.get('location')
+                   or doc.page_content[:64])
+
+    def _get_relevant_documents(self, query, **kwargs):
+        docs = super()._get_relevant_documents(query, **kwargs)
+        return sorted(docs, key=self._doc_sort_key)
+
 
 # Create the standard retriever
-retriever = AmazonKnowledgeBasesRetriever(
+retriever = StableOrderRetriever(
     knowledge_base_id=KNOWLEDGE_BASE_ID,
     region_name=region,
     client=bedrock_agent_client,
@@ -141,17 +473,17 @@ async def chat_profile():
             starters=[
                 cl.Starter(
                     label="Why do I need health insurance?",
-                    message="Can you help me to understand why do I need health insurance?.",
+                    message=STARTER_MESSAGES[0],
                     icon="/public/insurance-user-svgrepo-com.svg",
                 ),
                 cl.Starter(
                     label="What is the symptom of common cold?",
-                    message="Could you please tell me more about the symptom of common cold?",
+                    message=STARTER_MESSAGES[1],
                     icon="/public/first-aid-kit-doctor-svgrepo-com.svg",
                 ),
                 cl.Starter(
                     label="Tips for losing weight",
-                    message="Tips for losing weight",
+                    message=STARTER_MESSAGES[2],
                     icon="https://picsum.photos/230",
                 ),
             ],
@@ -161,6 +493,7 @@ async def chat_profile():
 
 @cl.on_chat_start
 async def start():
+    _maybe_start_warming()
     user = cl.user_session.get("user")
     chat_profile = cl.user_session.get("chat_profile")
     settings = None  # Initialize settings with a default value
@@ -214,65 +547,39 @@ async def start():
         await setup_agent(settings)
         
 
-@cl.on_settings_update
-async def setup_agent(settings):
-    print("on_settings_update", settings)
-
-    prompt_insurance = ChatPromptTemplate.from_messages(
-    [
-        ("system", """You are a health insurance agent and medical expert that is willing to help the user answer questions related to health insurance and common medical topic topics.
-          Your focus is not just selling the insurance product but also solving user's concerns related to healthcare and symptom of disease. Do not do hard selling, be humble.
-          Use the following pieces of context to answer the user's question. If you don't know the answer, just say that you don't know, don't try to make up an answer.
-          Use your internal knowledge first, if you do not have the answer, use knowledge bases, if you still do not know the answer, do not hallucinate. 
-         
-         Guidelines:
-          - Only provide factual medical information from reliable sources
-          - Do not give specific medical advice or diagnoses
-          - Refer users to healthcare professionals for medical concerns
-          - Do not discuss sensitive personal health information
-          - Focus on general insurance and healthcare topics
-          - Avoid answering questions unrelated to Insurance and Medical
-          - Never show table name in the response if users asks about insurance
-         
-         {context}
-         """),
-        ("human", "{question}"),
-    ])
+@functools.lru_cache(maxsize=32)
+def _build_runnable(model, temperature, max_tokens, top_p, use_kb, use_agent):
+    """Build the runnable for one settings combination, memoized.
 
+    Slider drags fire on_settings_update once per tick, and each call
+    used to rebuild the prompt, the Bedrock chat model and the chain
+    from scratch. Keying the builder on the scalar settings makes
+    repeat updates an O(1) cache hit. The runnables hold no per-session
+    state, so sharing them across sessions is safe.
     """
-    ChatPromptTemplate Explained:
-    system: This is used to baseline the AI assistant. 
-            If you want to set some behaviour of your assistant. 
-            This is the place to do it.
-    human: All the user inputs are to stored in this
-    """
-
-    guardrails={
-                'guardrailIdentifier': GUARDRAIL_ID,
-                'guardrailVersion': GUARDRAIL_VERSION,
-                'trace': "enabled"}
-    
-    if settings["Model"] == "Claude-3.7-Sonnet":
+    if model == "Claude-3.7-Sonnet":
         chat_model=ChatBedrockConverse(
             model = "us.anthropic.claude-3-7-sonnet-20250219-v1:0",
+            client=bedrock_client,
             region_name=region,
-            temperature=float(settings["Temperature"]),
-            max_tokens=int(settings["MaxTokens"]),
-            top_p=float(settings["topP"]),
+            temperature=temperature,
+            max_tokens=max_tokens,
+            top_p=top_p,
             guardrail_config=guardrails
         )
 
-    elif settings["Model"] == "Amazon-Nova-Pro":
+    elif model == "Amazon-Nova-Pro":
         chat_model=ChatBedrockConverse(
             model="amazon.nova-pro-v1:0",
+            client=bedrock_client,
             region_name=region,
-            temperature=float(settings["Temperature"]),
-            max_tokens=int(settings["MaxTokens"]),
-            top_p=float(settings["topP"]),
+            temperature=temperature,
+            max_tokens=max_tokens,
+            top_p=top_p,
             guardrail_config=guardrails
         )
 
-    if settings["UseKnowledgeBase"]:
+    if use_kb:
         qa_chain = RetrievalQA.from_chain_type(
             llm=chat_model,
             chain_type="stuff",
@@ -282,170 +589,333 @@ async def setup_agent(settings):
                 "prompt": prompt_insurance
             }
         )
-        runnable = qa_chain
+        return qa_chain
 
-    elif settings["UseAgent"]:
-        bedrock_agent_runnable = BedrockAgentsRunnable(
+    elif use_agent:
+        return BedrockAgentsRunnable(
             agent_id="your agent id",
             agent_alias_id="your agent alias id",
             client=bedrock_agent_client,
             guardrail_configuration=guardrails
         )
-        runnable = bedrock_agent_runnable
 
     else:
-        runnable = prompt_insurance | chat_model | StrOutputParser()
+        return prompt_insurance | chat_model | StrOutputParser()
+
+
+@cl.on_settings_update
+async def setup_agent(settings):
+    logger.info("on_settings_update %s", settings)
+
+    runnable = _build_runnable(
+        settings["Model"],
+        float(settings["Temperature"]),
+        int(settings["MaxTokens"]),
+        float(settings["topP"]),
+        bool(settings["UseKnowledgeBase"]),
+        bool(settings["UseAgent"]),
+    )
 
     cl.user_session.set("runnable", runnable)
-    
+    # One callback handler per session: it allocates listener state on
+    # construction, which every message was paying for
+    lc_handler = cl.LangchainCallbackHandler()
+    cl.user_session.set("lc_handler", lc_handler)
+    # The RunnableConfig is just a dict around the handler; build it
+    # once here instead of once per message in every branch
+    cl.user_session.set("run_config", RunnableConfig(callbacks=[lc_handler]))
+    # The warmed-starter path rebuilds the plain chat chain from these
+    cl.user_session.set("settings_scalars", (
+        settings["Model"],
+        float(settings["Temperature"]),
+        int(settings["MaxTokens"]),
+        float(settings["topP"]),
+    ))
+    # Bind the message handler here so main() doesn't need isinstance
+    # checks against heavy LangChain classes on every message
+    if settings["UseKnowledgeBase"]:
+        runnable_kind = "kb"
+    elif settings["UseAgent"]:
+        runnable_kind = "agent"
+    else:
+        runnable_kind = "chat"
+    cl.user_session.set("runnable_kind", runnable_kind)
+    # Semantic-cache answers are only valid for the model/mode that
+    # produced them, so the cache is selected with this key
+    cl.user_session.set("cache_key", (
+        settings["Model"],
+        bool(settings["UseKnowledgeBase"]),
+        bool(settings["UseAgent"]),
+    ))
+
+
+_SOURCE_SNIPPET_CHARS = 1200
+
+async def _send_source_documents(source_documents):
+    """Render retrieved source documents as one expandable side element.
+
+    Identical passages retrieved more than once are dropped (compared by
+    content digest), long passages are truncated, and all sources are
+    batched into a single element so the browser receives one websocket
+    frame instead of one per document.
+    """
+    seen_digests = set()
+    sections = []
+    for doc in source_documents:
+        digest = hashlib.blake2b(doc.page_content.encode(), digest_size=16).digest()
+        if digest in seen_digests:
+            continue
+        seen_digests.add(digest)
+        content = doc.page_content
+        if len(content) > _SOURCE_SNIPPET_CHARS:
+            content = content[:_SOURCE_SNIPPET_CHARS] + "… (truncated)"
+        sections.append(f"### Source {len(sections) + 1}\n\n{content}")
+
+    if not sections:
+        return
+    await cl.Message(
+        content="📚 Reference Source (click to show):",
+        elements=[cl.Text(name="Sources", content="\n\n".join(sections), display="side")]
+    ).send()
+
+
+async def _append_timing(final_msg, start):
+    """Append the elapsed time to the answer message when enabled.
+
+    perf_counter is monotonic (time.time can step under NTP), and
+    folding the timing into the existing message costs one update frame
+    instead of a whole extra message.
+    """
+    if _SHOW_TIMING and final_msg is not None and final_msg.content:
+        final_msg.content += f"\n\n_Response time: {time.perf_counter() - start:.2f}s_"
+        await final_msg.update()
+
+
+async def _with_retry_and_loading(operation, loading_text, error_text):
+    """Run an operation under the Aurora retry harness with a loading
+    message shown until its first output.
+
+    The loading send is started as a task so the operation begins
+    without waiting for the websocket round-trip. The operation
+    receives a clear_loading coroutine it can call when tokens start
+    flowing. Returns (result, loading_msg): on success the loading
+    message is handed back (None if already cleared) so the caller can
+    update it in place — one frame — instead of a remove plus a fresh
+    send. On failure it is removed and (None, None) returned after the
+    friendly error message.
+    """
+    loading_msg = cl.Message(content=loading_text)
+    loading_task = asyncio.create_task(loading_msg.send())
+    cleared = False
+
+    async def clear_loading():
+        nonlocal cleared
+        if not cleared:
+            cleared = True
+            await loading_task
+            await loading_msg.remove()
+
+    try:
+        result = await retry_on_aurora_resuming(lambda: operation(clear_loading))
+    except Exception as e:
+        await clear_loading()
+        # For debugging purposes, log the error but don't show it to the user
+        logger.exception("Error occurred: %s", e)
+        # Show a friendly message instead of the error
+        await cl.Message(content=error_text).send()
+        return None, None
+    await loading_task
+    return result, (None if cleared else loading_msg)
+
+
+async def handle_kb(runnable, message, msg, cache, query_vec):
+    """Knowledge-base branch: stream the RetrievalQA answer."""
+    run_config = (cl.user_session.get("run_config")
+                  or RunnableConfig(callbacks=[cl.LangchainCallbackHandler()]))
+    # Warmed starter prompts skip retrieval entirely: generate from the
+    # precomputed context with the (memoized) plain chat chain
+    context = _starter_contexts.get(_normalize_query(message.content))
+    scalars = cl.user_session.get("settings_scalars")
+    if context is not None and scalars is not None:
+        chat_chain = _build_runnable(*scalars, False, False)
+        try:
+            async for chunk in chat_chain.astream(
+                {"question": message.content, "context": context},
+                config=run_config,
+            ):
+                await msg.stream_token(chunk)
+            if cache is not None and msg.content:
+                cache.store(query_vec, msg.content)
+            return msg if msg.content else None
+        except Exception as e:
+            # For debugging purposes, log the error but don't show it to the user
+            logger.exception("Error occurred: %s", e)
+            await cl.Message(content="I'm having trouble generating a response. Please try again in a moment.").send()
+            return None
+
+    async def retrieval_operation(clear_loading):
+        # This is where we need to handle the Aurora DB resumption error
+        try:
+            answer_parts = []
+            source_documents = []
+            async for chunk in runnable.astream(
+                {"query": message.content},
+                config=run_config,
+            ):
+                token = chunk.get("result") or chunk.get("answer") or ""
+                if token:
+                    # First token: swap the loading message for the stream
+                    await clear_loading()
+                    answer_parts.append(token)
+                    await msg.stream_token(token)
+                # LangChain emits the sources in the terminal chunk
+                if chunk.get("source_documents"):
+                    source_documents = chunk["source_documents"]
+            return "".join(answer_parts), source_documents
+        except botocore.exceptions.ClientError as e:
+            if _is_aurora_resuming(e):
+                # Re-raise to be caught by the retry mechanism
+                raise
+            # For other errors, wrap them to provide more context
+            raise Exception(f"Error during retrieval: {str(e)}")
+
+    result, loading_msg = await _with_retry_and_loading(
+        retrieval_operation,
+        "Retrieving information...",
+        "I'm having trouble connecting to the knowledge base. Please try again in a moment.",
+    )
+    if result is None:
+        return None
+    answer, source_documents = result
+
+    if msg.content:
+        answer_msg = msg
+        await msg.update()
+    elif loading_msg is not None:
+        # Nothing was streamed (e.g. a non-streaming chain build);
+        # turn the loading message into the answer in place
+        loading_msg.content = answer
+        await loading_msg.update()
+        answer_msg = loading_msg
+    else:
+        msg.content = answer
+        await msg.send()
+        answer_msg = msg
+
+    # Create side elements for sources
+    if 'Sorry, the model cannot answer this question.' in answer:
+        pass
+    else:
+        if source_documents:
+            await _send_source_documents(source_documents)
+        if cache is not None:
+            cache.store(query_vec, answer, source_documents)
+    return answer_msg
+
+
+async def handle_agent(runnable, message, msg, cache, query_vec):
+    """Agent branch: invoke the Bedrock agent."""
+    run_config = (cl.user_session.get("run_config")
+                  or RunnableConfig(callbacks=[cl.LangchainCallbackHandler()]))
+    async def agent_operation(clear_loading):
+        try:
+            return await runnable.ainvoke(
+                {
+                    "input": message.content
+                },
+                config=run_config,
+            )
+        except botocore.exceptions.ClientError as e:
+            if _is_aurora_resuming(e):
+                # Re-raise to be caught by the retry mechanism
+                raise
+            # For other errors, wrap them to provide more context
+            raise Exception(f"Error during agent operation: {str(e)}")
+
+    response, loading_msg = await _with_retry_and_loading(
+        agent_operation,
+        "Processing your request...",
+        "I'm having trouble processing your request. Please try again in a moment.",
+    )
+    if response is None:
+        return None
+
+    answer = response.return_values['output']
+    if loading_msg is not None:
+        # Turn the loading message into the answer in place
+        loading_msg.content = answer
+        await loading_msg.update()
+        answer_msg = loading_msg
+    else:
+        msg.content = answer
+        await msg.send()
+        answer_msg = msg
+    if cache is not None:
+        cache.store(query_vec, answer)
+    return answer_msg
+
+
+async def handle_chat(runnable, message, msg, cache, query_vec):
+    """Plain chat branch: stream the LCEL chain without a knowledge base."""
+    run_config = (cl.user_session.get("run_config")
+                  or RunnableConfig(callbacks=[cl.LangchainCallbackHandler()]))
+    try:
+        async for chunk in runnable.astream(
+            {"question": message.content, "context": ""},  # Provide empty context when KB is disabled
+            config=run_config,
+        ):
+            await msg.stream_token(chunk)
+        if cache is not None and msg.content:
+            cache.store(query_vec, msg.content)
+        return msg if msg.content else None
+    except Exception as e:
+        # For debugging purposes, log the error but don't show it to the user
+        logger.exception("Error occurred: %s", e)
+
+        # Show a friendly message instead of the error
+        await cl.Message(content="I'm having trouble generating a response. Please try again in a moment.").send()
+        return None
+
+
+HANDLERS = {"kb": handle_kb, "agent": handle_agent, "chat": handle_chat}
+
+# Timing costs an extra websocket update per turn; only pay for it when
+# explicitly asked for
+_SHOW_TIMING = os.environ.get("SHOW_TIMING") == "1"
+
 
 @cl.on_message
 async def main(message: cl.Message):
-    start = time.time()
+    start = time.perf_counter()
     runnable = cl.user_session.get("runnable")
 
     msg = cl.Message(content="")
-    loading_msg = None
 
-    if isinstance(runnable, RetrievalQA):
-        # Show a loading message while we wait for the database
-        loading_msg = cl.Message(content="Retrieving information...")
-        await loading_msg.send()
-        
-        # Use retry mechanism for RetrievalQA
-        async def retrieval_operation():
-            # This is where we need to handle the Aurora DB resumption error
-            try:
-                return await runnable.ainvoke(
-                    {"query": message.content},
-                    config=RunnableConfig(callbacks=[cl.LangchainCallbackHandler()]),
-                )
-            except botocore.exceptions.ClientError as e:
-                error_code = e.response.get('Error', {}).get('Code', '')
-                error_message = str(e)
-                
-                if (error_code == 'ValidationException' and 
-                    ('resuming after being auto-paused' in error_message or 
-                     'is in stopped state' in error_message)):
-                    # Re-raise to be caught by the retry mechanism
-                    raise
-                else:
-                    # For other errors, wrap them to provide more context
-                    raise Exception(f"Error during retrieval: {str(e)}")
-        
+    # Check the semantic cache before paying for a Bedrock round-trip
+    cache = None
+    query_vec = None
+    cache_key = cl.user_session.get("cache_key")
+    if cache_key is not None and os.environ.get("SEMANTIC_CACHE", "1") != "0":
         try:
-            # Apply retry mechanism to the retrieval operation
-            response = await retry_on_aurora_resuming(retrieval_operation)
-            
-            # Remove the loading message
-            if loading_msg:
-                await loading_msg.remove()
-            
-            answer = response['result']
-            source_documents = response['source_documents']
-
-            # Send the main answer
-            msg.content = answer
-            await msg.send()
-
-            # Create side elements for sources
-            if 'Sorry, the model cannot answer this question.' in answer:
-                pass
-            elif source_documents:
-                elements = []
-                for i, doc in enumerate(source_documents, 1):
-                    source_content = f"Content: {doc.page_content}\n"
-                    # Create an expandable text element for each source
-                    elements.append(
-                        cl.Text(
-                            name=f"Source",
-                            content=source_content,
-                            display="side"
-                        )
-                    )
-                
-                # Send a new message with the source elements
-                await cl.Message(
-                    content="📚 Reference Source (click to show):",
-                    elements=elements
-                ).send()
+            query_vec = await _embed_text(message.content)
+            cache = _semantic_cache_for(cache_key)
+            cached = cache.lookup(query_vec)
         except Exception as e:
-            # Remove the loading message
-            if loading_msg:
-                await loading_msg.remove()
-                
-            # For debugging purposes, log the error but don't show it to the user
-            print(f"Error occurred: {str(e)}")
-            
-            # Show a friendly message instead of the error
-            await cl.Message(content="I'm having trouble connecting to the knowledge base. Please try again in a moment.").send()
-
-    elif isinstance(runnable, BedrockAgentsRunnable):
-        # Show a loading message while we wait for the database
-        loading_msg = cl.Message(content="Processing your request...")
-        await loading_msg.send()
-        
-        # Use retry mechanism for BedrockAgentsRunnable
-        async def agent_operation():
-            try:
-                return await runnable.ainvoke(
-                    {
-                        "input": message.content
-                    },
-                    config=RunnableConfig(callbacks=[cl.LangchainCallbackHandler()]),
-                )
-            except botocore.exceptions.ClientError as e:
-                error_code = e.response.get('Error', {}).get('Code', '')
-                error_message = str(e)
-                
-                if (error_code == 'ValidationException' and 
-                    ('resuming after being auto-paused' in error_message or 
-                     'is in stopped state' in error_message)):
-                    # Re-raise to be caught by the retry mechanism
-                    raise
-                else:
-                    # For other errors, wrap them to provide more context
-                    raise Exception(f"Error during agent operation: {str(e)}")
-        
-        try:
-            # Apply retry mechanism to the agent operation
-            response = await retry_on_aurora_resuming(agent_operation)
-            
-            # Remove the loading message
-            if loading_msg:
-                await loading_msg.remove()
-                
-            answer = response.return_values['output']
+            # Cache problems must never block the real answer path
+            logger.warning("Semantic cache lookup failed: %s", e)
+            cached = None
+
+        if cached is not None:
+            answer, source_documents = cached
             msg.content = answer
             await msg.send()
-        except Exception as e:
-            # Remove the loading message
-            if loading_msg:
-                await loading_msg.remove()
-                
-            # For debugging purposes, log the error but don't show it to the user
-            print(f"Error occurred: {str(e)}")
-            
-            # Show a friendly message instead of the error
-            await cl.Message(content="I'm having trouble processing your request. Please try again in a moment.").send()
-    
-    else:
-        # Case when knowledge base is disabled
-        msg = cl.Message(content="")
+            if source_documents:
+                await _send_source_documents(source_documents)
+            await _append_timing(msg, start)
+            return
 
-        try:
-            async for chunk in runnable.astream(
-                {"question": message.content, "context": ""},  # Provide empty context when KB is disabled
-                config=RunnableConfig(callbacks=[cl.LangchainCallbackHandler()]),
-            ):
-                await msg.stream_token(chunk)
-        except Exception as e:
-            # For debugging purposes, log the error but don't show it to the user
-            print(f"Error occurred: {str(e)}")
-            
-            # Show a friendly message instead of the error
-            await cl.Message(content="I'm having trouble generating a response. Please try again in a moment.").send()
+    handler = HANDLERS[cl.user_session.get("runnable_kind") or "chat"]
+    final_msg = await handler(runnable, message, msg, cache, query_vec)
 
     # Only show response time if we successfully completed the operation
-    if msg.content:
-        await cl.Message(content=f'Response time: {time.time() - start:.2f}s').send()
+    await _append_timing(final_msg, start)